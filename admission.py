@@ -0,0 +1,204 @@
+"""
+Admission control and load shedding.
+
+Requests are sorted into classes (cheap reads, peer chain sync,
+writes, mining, admin). Every class has a token bucket for the whole node, one per
+client, and optionally a cap on how many of its requests run at once.
+Expensive classes are also refused as soon as the node is half busy,
+which keeps capacity free for lookups. Refused requests fail fast with
+Overloaded instead of queueing up.
+"""
+
+import collections
+import logging
+import math
+import queue
+import threading
+from contextlib import contextmanager
+from time import monotonic
+
+logger = logging.getLogger(__name__)
+
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after=1.0):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        """
+        :param rate: tokens added per second
+        :param burst: most tokens the bucket holds
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        :return: 0 if a token was taken, else seconds until one is available
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RequestClass(object):
+    def __init__(self, rate, burst, client_rate, client_burst, concurrency=None, cheap=False, scale=None):
+        """
+        :param rate, burst: token bucket shared by every client
+        :param client_rate, client_burst: token bucket for each client
+        :param concurrency: most requests of this class running at once
+        :param cheap: cheap classes keep being admitted when the node is busy
+        :param scale: optional callable, the shared rate and burst are
+        multiplied by what it returns (e.g. the number of peers)
+        """
+        self.rate = rate
+        self.burst = burst
+        self.scale = scale
+        self.bucket = TokenBucket(rate, burst)
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.cheap = cheap
+
+
+class AdmissionController(object):
+    def __init__(self, classes, max_in_flight=64, max_clients=10000):
+        """
+        :param classes: dict of class name -> RequestClass
+        :param max_in_flight: requests the node works on at once, expensive
+        classes are refused from half of it on
+        :param max_clients: per-client buckets kept, least recently seen
+        clients are forgotten first
+        """
+        self.classes = classes
+        self.max_in_flight = max_in_flight
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self.lock = threading.Lock()
+        self.clients = collections.OrderedDict()
+        self.shed = collections.Counter()
+
+    def client_bucket(self, name, client):
+        key = (name, client)
+        with self.lock:
+            bucket = self.clients.get(key)
+            if bucket is None:
+                request_class = self.classes[name]
+                bucket = TokenBucket(request_class.client_rate, request_class.client_burst)
+                self.clients[key] = bucket
+                if len(self.clients) > self.max_clients:
+                    self.clients.popitem(last=False)
+            else:
+                self.clients.move_to_end(key)
+            return bucket
+
+    def reject(self, name, reason, retry_after=1.0):
+        self.shed[name] += 1
+        raise Overloaded(reason, retry_after)
+
+    def acquire(self, name, client):
+        """
+        Admit a request, every admitted request must be released
+
+        :param name: class of the request
+        :param client: address of the client
+        :raises Overloaded: if the request has to be shed
+        """
+        request_class = self.classes[name]
+
+        with self.lock:
+            limit = self.max_in_flight if request_class.cheap else self.max_in_flight // 2
+            busy = self.in_flight >= limit
+        if busy:
+            self.reject(name, 'Node is overloaded')
+
+        wait = self.client_bucket(name, client).take()
+        if wait:
+            self.reject(name, 'Client rate limit exceeded', wait)
+        if request_class.scale is not None:
+            factor = max(1, request_class.scale())
+            request_class.bucket.rate = request_class.rate * factor
+            request_class.bucket.burst = request_class.burst * factor
+        wait = request_class.bucket.take()
+        if wait:
+            self.reject(name, 'Rate limit exceeded', wait)
+
+        if request_class.slots is not None and not request_class.slots.acquire(blocking=False):
+            self.reject(name, 'Too many concurrent requests')
+
+        with self.lock:
+            self.in_flight += 1
+
+    def release(self, name):
+        with self.lock:
+            self.in_flight -= 1
+        if self.classes[name].slots is not None:
+            self.classes[name].slots.release()
+
+    @contextmanager
+    def admit(self, name, client):
+        self.acquire(name, client)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def stats(self):
+        return {'in_flight': self.in_flight, 'shed': dict(self.shed)}
+
+
+class WorkQueue(object):
+    def __init__(self, func, maxsize=8):
+        """
+        A bounded queue with a single worker thread calling func(item).
+        An item already waiting is not queued a second time.
+        The thread is started on first use, so it is not lost when a
+        server forks its workers after importing this module.
+        """
+        self.func = func
+        self.queue = queue.Queue(maxsize)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, item):
+        """
+        :raises Overloaded: if the queue is full
+        """
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if item in self.pending:
+                return
+            try:
+                self.queue.put_nowait(item)
+            except queue.Full:
+                raise Overloaded('Work queue is full')
+            self.pending.add(item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            with self.lock:
+                self.pending.discard(item)
+            try:
+                self.func(item)
+            except Exception:
+                # a failing neighbour must not kill the worker
+                logger.exception('Queued work for %s failed', item)
+
+
+def retry_after_header(error):
+    return str(max(1, math.ceil(error.retry_after)))
@@ -4,14 +4,19 @@ Modified to fit the DNS scenario
 """
 
 import hashlib
-from time import time
+from time import sleep, time
 from uuid import uuid4
-from urllib.parse import urlparse
+from urllib.parse import quote, urlparse
 import json
+import logging
 import requests
 
+from diagnostics import phase, timed
+
+logger = logging.getLogger(__name__)
+
 class Blockchain(object):
-	def __init__(self,node_identifier):
+	def __init__(self,node_identifier,transport=requests,shard=None):
 		"""
 		Initializes the class
 
@@ -22,11 +27,26 @@ class Blockchain(object):
 
 		Nodes is a set keeping track of all the other nodes.
 		This is required since we need to broadcast information to other nodes
+
+		Transport is what we talk to the other nodes with, anything with
+		a requests-like get() works (see simulator.py)
+
+		Indexes are secondary views of the chain, each one has
+		add_block(block) called on append and rebuild(chain) on replacement
+
+		Shard is the name of the part of the namespace this chain holds,
+		None when it holds all of it (see sharding.py)
 		"""
 		self.current_transactions = []
 		self.chain = []
 		self.nodes = set()
 		self.node_identifier = node_identifier
+		self.transport = transport
+		self.indexes = []
+		self.shard = shard
+		# how often and how long we wait for a peer that sheds us with 429
+		self.PEER_RETRIES = 3
+		self.MAX_RETRY_WAIT = 5
 
 		# create the genesis block
 		# this is a hardcoded block which serves as the first block
@@ -43,9 +63,10 @@ class Blockchain(object):
 		# parsed_url = urlparse(address)
 		# self.nodes.add(parsed_url.netloc)
 		self.nodes.add(address)
-		print(self.nodes)
+		logger.debug('Registered node %s, %d nodes known', address, len(self.nodes))
 
 	@property
+	@timed('quota')
 	def quota(self):
 		"""
 		Go through the chain and calculate the quota (publish cash) we have
@@ -63,6 +84,13 @@ class Blockchain(object):
 					quota -= 1
 		return quota
 
+	@property
+	def shard_query(self):
+		"""
+		Query string selecting our shard on other nodes' endpoints
+		"""
+		return '' if self.shard is None else f'?shard={quote(self.shard)}'
+
 	@property
 	def last_block(self):
 		"""
@@ -113,8 +141,9 @@ class Blockchain(object):
 			yield num
 			num += 1
 			if num%100 == 0:
-				print("Generating salt...")
+				logger.debug("Generating salt...")
 
+	@timed('proof_of_work')
 	def proof_of_work(self, last_proof):
 		"""
 		A proof of work algo. Iterate over different values of salt
@@ -124,7 +153,7 @@ class Blockchain(object):
 		salt = next(salt_gen)
 		while not self.valid_proof(last_proof,salt):
 			salt = next(salt_gen)
-		print("POW generated")
+		logger.debug("POW generated")
 		return salt
 
 	def new_transaction(self,transaction):
@@ -162,8 +191,67 @@ class Blockchain(object):
 		self.current_transactions = []
 
 		self.chain.append(block)
-		return block        
+		for index in self.indexes:
+			index.add_block(block)
+		return block
+
+	def add_index(self,index):
+		"""
+		Register a secondary index and build it from the current chain
+		"""
+		self.indexes.append(index)
+		index.rebuild(self.chain)
+
+	def replace_chain(self,chain):
+		"""
+		Swap in a whole new chain and rebuild every index from it
+		"""
+		self.chain = chain
+		for index in self.indexes:
+			index.rebuild(chain)
 
+	@staticmethod
+	def retry_after(response):
+		"""
+		Seconds a peer asked us to wait in its Retry-After header
+		"""
+		try:
+			return float(response.headers.get('Retry-After', 1))
+		except ValueError:
+			return 1.0
+
+	def request_peers(self,nodes,path,retries=None):
+		"""
+		GET path on every node. Nodes that shed us with a 429 are asked
+		again after their Retry-After (at most MAX_RETRY_WAIT seconds)
+		instead of being dropped.
+
+		:param retries: rounds of retries, PEER_RETRIES if None. With 0
+		nothing sleeps, for callers on a request path
+		:return: generator of (node, response), nodes that keep refusing
+		come out with their last 429
+		"""
+		retries = self.PEER_RETRIES if retries is None else retries
+		pending = list(nodes)
+		for attempt in range(retries + 1):
+			refused = []
+			wait = 0
+			for node in pending:
+				with phase('neighbour'):
+					response = self.transport.get(f'http://{node}{path}')
+				if response.status_code == 429 and attempt < retries:
+					refused.append(node)
+					wait = max(wait, self.retry_after(response))
+				else:
+					yield node, response
+
+			if not refused:
+				return
+			logger.info('%d nodes shed %s, retrying in %.1fs', len(refused), path, wait)
+			sleep(min(wait, self.MAX_RETRY_WAIT))
+			pending = refused
+
+	@timed('resolve_conflicts')
 	def resolve_conflicts(self):
 		"""
 		This is our consensus algorithm, it resolves conflicts
@@ -179,11 +267,7 @@ class Blockchain(object):
 		max_length = len(self.chain)
 
 		# Grab and verify the chains from all the nodes in our network
-		for node in neighbours:
-			node_addr = f'http://{node}/nodes/chain'
-			# print(node_addr)
-			response = requests.get(node_addr)
-
+		for node, response in self.request_peers(neighbours, f'/nodes/chain{self.shard_query}'):
 			if response.status_code == 200:
 				length = response.json()['length']
 				chain = response.json()['chain']
@@ -195,12 +279,13 @@ class Blockchain(object):
 
 		# Replace our chain if we discovered a new, valid chain longer than ours
 		if new_chain:
-			self.chain = new_chain
+			self.replace_chain(new_chain)
 			return True
 
 		return False
 
 	@classmethod
+	@timed('valid_chain')
 	def valid_chain(cls,chain):
 		"""
 		Determine if a given blockchain is valid
@@ -214,9 +299,7 @@ class Blockchain(object):
 
 		while current_index < len(chain):
 			block = chain[current_index]
-			print(f'{last_block}')
-			print(f'{block}')
-			print("\n-----------\n")
+			logger.debug('Validating block %s after %s', block, last_block)
 			# Check that the hash of the block is correct
 			if block['previous_hash'] != cls.hash(last_block):
 				return False
@@ -0,0 +1,126 @@
+"""
+Bloom filter over every hostname committed to the ledger.
+
+A hostname the filter has never seen is certainly not in the chain, so
+lookups for it can be answered without scanning any block. This is the
+common case in random-subdomain floods. The filter grows as a scalable
+Bloom filter: when one stage is full a bigger stage with a tighter error
+rate is added, so the overall false positive rate stays bounded.
+"""
+
+import hashlib
+import math
+
+
+def check_filter_args(capacity, error_rate):
+	"""
+	:raises ValueError: if a filter cannot be sized with these values
+	"""
+	if not isinstance(capacity, int) or capacity < 1:
+		raise ValueError(f'Filter capacity must be a positive integer, got {capacity}')
+	if not 0 < error_rate < 1:
+		raise ValueError(f'Filter error rate must be between 0 and 1, got {error_rate}')
+
+
+class BloomFilter(object):
+	def __init__(self, capacity, error_rate):
+		"""
+		:param capacity: number of items before the error rate is exceeded
+		:param error_rate: false positive rate at capacity
+		"""
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+		self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def positions(self, key):
+		# double hashing, k positions out of two 64 bit hashes
+		digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+		h1 = int.from_bytes(digest[:8], 'little')
+		h2 = int.from_bytes(digest[8:], 'little') | 1
+		return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+	def add(self, key):
+		for position in self.positions(key):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, key):
+		return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class HostnameFilter(object):
+	def __init__(self, capacity=100000, error_rate=0.001):
+		"""
+		:param capacity: hostnames the first stage holds
+		:param error_rate: target false positive rate of the whole filter
+		:raises ValueError: if capacity or error_rate is out of range
+		"""
+		check_filter_args(capacity, error_rate)
+		self.capacity = capacity
+		self.error_rate = error_rate
+		self.checks = 0
+		self.misses = 0
+		self.rebuild([])
+
+	def new_stage(self, stages):
+		# every stage is twice as big and gets half the error budget
+		# of the previous one, so the total stays under error_rate
+		n = len(stages)
+		return BloomFilter(self.capacity * 2 ** n, self.error_rate / 2 ** (n + 1))
+
+	def rebuild(self, chain):
+		"""
+		Build the filter from scratch and swap it in at the end
+		"""
+		stages = [self.new_stage([])]
+		for block in chain:
+			self._add_block(stages, block)
+		self._stages = stages
+
+	def add_block(self, block):
+		self._add_block(self._stages, block)
+
+	def _add_block(self, stages, block):
+		for transaction in block['transactions']:
+			if transaction.get('hostname') is None:
+				continue
+			hostname = str(transaction['hostname'])
+			if self.contains(stages, hostname):
+				continue
+			if stages[-1].count >= stages[-1].capacity:
+				stages.append(self.new_stage(stages))
+			stages[-1].add(hostname)
+
+	@staticmethod
+	def contains(stages, hostname):
+		return any(hostname in stage for stage in stages)
+
+	def might_contain(self, hostname):
+		"""
+		:return: False if hostname is certainly not in the ledger
+		"""
+		self.checks += 1
+		if self.contains(self._stages, str(hostname)):
+			return True
+		self.misses += 1
+		return False
+
+	def stats(self):
+		stages = self._stages
+		# chance that a name never added still hits every bit in some stage
+		false_positive_rate = 1 - math.prod(
+			1 - (1 - math.exp(-stage.hash_count * stage.count / stage.size)) ** stage.hash_count
+			for stage in stages)
+		return {
+			'hostnames': sum(stage.count for stage in stages),
+			'stages': len(stages),
+			'capacity': sum(stage.capacity for stage in stages),
+			'target_error_rate': self.error_rate,
+			'estimated_false_positive_rate': false_positive_rate,
+			'memory_bytes': sum(len(stage.bits) for stage in stages),
+			'checks': self.checks,
+			'definite_misses': self.misses,
+		}
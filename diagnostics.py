@@ -0,0 +1,167 @@
+"""
+Diagnostics for a running node.
+
+- SamplingProfiler samples the stacks of every thread for a while and
+  returns them in the folded format flame graph tools read
+  (one 'frame;frame;frame count' line per distinct stack).
+- phase()/timed() record how long each part of a request took, and
+  SlowRequestLog keeps the slowest recent requests with that breakdown.
+- RateLimitFilter keeps hot-path log messages from flooding the output.
+"""
+
+import collections
+import functools
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class SamplingProfiler(object):
+    def __init__(self, interval=0.005):
+        """
+        :param interval: seconds between two samples
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def sample(self, ignore):
+        stacks = []
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id in ignore:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                frame = frame.f_back
+            stacks.append(';'.join(reversed(stack)))
+        return stacks
+
+    def profile(self, seconds):
+        """
+        Sample every thread for a number of seconds, blocking the caller
+
+        :return: the folded stacks as text
+        :raises RuntimeError: if a profile is already running
+        """
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError('A profile is already running')
+        try:
+            counts = collections.Counter()
+            ignore = {threading.get_ident()}
+            deadline = time.monotonic() + seconds
+            while time.monotonic() < deadline:
+                counts.update(self.sample(ignore))
+                time.sleep(self.interval)
+        finally:
+            self.lock.release()
+
+        return ''.join(f'{stack} {count}\n' for stack, count in counts.most_common())
+
+
+_local = threading.local()
+
+
+def start_trace():
+    _local.trace = collections.defaultdict(float)
+
+
+def stop_trace():
+    """
+    :return: seconds spent per phase since start_trace
+    """
+    trace = getattr(_local, 'trace', None)
+    _local.trace = None
+    return dict(trace or {})
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a block of code as part of the request being traced on this
+    thread. Does nothing outside of a traced request.
+    """
+    trace = getattr(_local, 'trace', None)
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace[name] += time.perf_counter() - start
+
+
+def timed(name):
+    """
+    Decorator version of phase
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SlowRequestLog(object):
+    def __init__(self, size=100, threshold=0.1):
+        """
+        :param size: number of requests kept, older ones fall out
+        :param threshold: requests faster than this many seconds are not kept
+        """
+        self.threshold = threshold
+        self.requests = collections.deque(maxlen=size)
+
+    def record(self, method, path, status, duration, phases):
+        if duration < self.threshold:
+            return
+        self.requests.append({
+            'method': method,
+            'path': path,
+            'status': status,
+            'timestamp': time.time(),
+            'duration': duration,
+            'phases': phases,
+        })
+
+    def slowest(self, limit=None):
+        return sorted(self.requests, key=lambda r: r['duration'], reverse=True)[:limit]
+
+
+class RateLimitFilter(logging.Filter):
+    def __init__(self, rate=10, per=1.0):
+        """
+        Let at most rate records with the same message template through
+        every per seconds, and report how many were dropped.
+        """
+        super().__init__()
+        self.rate = rate
+        self.per = per
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - start >= self.per:
+                start, count = now, 0
+            if count >= self.rate:
+                self.windows[key] = (start, count, suppressed + 1)
+                return False
+            self.windows[key] = (start, count + 1, 0)
+
+        if suppressed:
+            record.msg = f'{record.msg} ({suppressed} similar messages suppressed)'
+        return True
+
+
+def configure_logging(level='WARNING', rate=10, per=1.0):
+    logging.basicConfig(level=level, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RateLimitFilter(rate, per))
@@ -1,5 +1,13 @@
+import logging
+import threading
+from time import monotonic
+
 import blockchain as bc
 import requests
+from admission import Overloaded, WorkQueue
+from bloom import HostnameFilter
+from diagnostics import phase, timed
+from reverse_index import ReverseIndex
 
 """
 Define the format of DNS transaction here
@@ -10,17 +18,32 @@ dns_transaction = {
 }
 """
 
+logger = logging.getLogger(__name__)
+
 class dns_layer(object):
-	def __init__(self, node_identifier):
+	def __init__(self, node_identifier, transport=requests, shard=None,
+		filter_capacity=100000, filter_error_rate=0.001):
 		"""
 		Initialize a blockchain object
 		BUFFER_MAX_LEN is the number of entries per block
+		transport is used for every call to other nodes
+		shard is set when this layer only holds one shard of the namespace
+		filter_capacity and filter_error_rate size the Bloom filter
+		that answers lookups for unknown hostnames
 		"""
-		self.blockchain = bc.Blockchain(node_identifier)
+		self.blockchain = bc.Blockchain(node_identifier, transport, shard)
+		self.transport = transport
+		self.reverse_index = ReverseIndex()
+		self.blockchain.add_index(self.reverse_index)
+		self.hostname_filter = HostnameFilter(filter_capacity, filter_error_rate)
+		self.blockchain.add_index(self.hostname_filter)
+		# neighbours that shed a broadcast are asked again off the request path
+		self.broadcast_retries = WorkQueue(self.retry_broadcast, maxsize=64)
 		self.BUFFER_MAX_LEN = 20
 		self.MINE_REWARD = 10
 		self.node_identifier = node_identifier
 
+	@timed('lookup')
 	def lookup(self,hostname):
 		"""
 		Goes through all the blocks in the chain to look
@@ -29,6 +52,10 @@ class dns_layer(object):
 		:param hostname: string, target hostname we are looking for
 		:return: a tuple (ip,port)
 		"""
+		# names never committed are rejected without touching the chain
+		if not self.hostname_filter.might_contain(hostname):
+			raise LookupError('No existing entry matching hostname')
+
 		for block in self.blockchain.chain:
 			transactions = block['transactions']
 			for transaction in transactions:
@@ -37,6 +64,48 @@ class dns_layer(object):
 					return (transaction['ip'],transaction['port'])
 		raise LookupError('No existing entry matching hostname')
 
+	@timed('lookup')
+	def batch_lookup(self,hostnames):
+		"""
+		Resolves many hostnames with a single pass over the chain.
+		As in lookup, the first matching transaction wins.
+
+		:param hostnames: iterable of hostnames we are looking for
+		:return: a dict mapping each hostname found to a tuple (ip,port),
+		missing hostnames are left out
+		"""
+		pending = {hostname for hostname in hostnames if self.hostname_filter.might_contain(hostname)}
+		found = {}
+		for block in self.blockchain.chain:
+			if not pending:
+				break
+			for transaction in block['transactions']:
+				hostname = transaction.get('hostname')
+				if hostname in pending:
+					found[hostname] = (transaction['ip'],transaction['port'])
+					pending.discard(hostname)
+		return found
+
+	def reverse_lookup(self,ip):
+		"""
+		Finds the hostnames pointing at an ip through the reverse index,
+		without going through the chain.
+
+		:param ip: string, target ip we are looking for
+		:return: a list of hostnames
+		"""
+		hostnames = self.reverse_index.lookup(ip)
+		if not hostnames:
+			raise LookupError('No existing entry matching ip')
+		return hostnames
+
+	def reverse_lookup_network(self,network):
+		"""
+		:param network: string, CIDR prefix such as '10.0.0.0/8'
+		:return: a list of (hostname,ip) for addresses inside network
+		"""
+		return self.reverse_index.lookup_network(network)
+
 	def mine_block(self):
 		"""
 		here we assume only the node will full buffer will mine
@@ -63,6 +132,7 @@ class dns_layer(object):
 		self.blockchain.new_transaction(new_transaction)
 		return proof
 
+	@timed('broadcast')
 	def broadcast_new_block(self):
 		"""
 		Broadcast resolve request to all neighbor to force neighbors
@@ -70,14 +140,29 @@ class dns_layer(object):
 		"""
 		neighbors = self.blockchain.nodes
 
-		for node in neighbors:
-			print(f"Requesting {node} to resolve")
-			response = requests.get(f'http://{node}/nodes/resolve')
+		# runs while a write holds its admission slot, so nothing waits
+		# here for a neighbour that sheds us
+		path = f'/nodes/resolve{self.blockchain.shard_query}'
+		for node, response in self.blockchain.request_peers(neighbors, path, retries=0):
+			logger.debug("Requested %s to resolve, answered %s", node, response.status_code)
+			if response.status_code == 429:
+				try:
+					self.broadcast_retries.submit(node)
+				except Overloaded:
+					logger.warning("Too many broadcast retries queued, dropping %s", node)
 			# if response.status_code != 200:
 			# 	raise ValueError(f'Node {node} responded bad status code')
-			# print(f"{node} resolve completed")
 
-		print("Broadcast Complete")
+		logger.info("Broadcast to %d nodes complete", len(neighbors))
+
+	def retry_broadcast(self,node):
+		"""
+		Ask a neighbour that shed our broadcast again, waiting for its
+		Retry-After. Runs on the broadcast_retries worker thread.
+		"""
+		path = f'/nodes/resolve{self.blockchain.shard_query}'
+		for node, response in self.blockchain.request_peers([node], path):
+			logger.debug("Requested %s to resolve again, answered %s", node, response.status_code)
 
 	def new_entry(self,hostname,ip,port):
 		"""
@@ -96,7 +181,7 @@ class dns_layer(object):
 		if buffer_len >= self.BUFFER_MAX_LEN or buffer_len >= self.blockchain.quota-self.BUFFER_MAX_LEN:
 			self.mine_block()
 			
-	def dump_chain(self):
+	def dump_chain(self,shard=None):
 		response = {
 		'chain': self.blockchain.chain,
 		'length': len(self.blockchain.chain)
@@ -109,13 +194,347 @@ class dns_layer(object):
 	def get_chain_quota(self):
 		return self.blockchain.quota
 
+	def get_filter_stats(self):
+		return self.hostname_filter.stats()
+
 	def register_node(self,addr):
 		self.blockchain.register_node(addr)
 
 	def get_network_size(self):
 		return len(self.blockchain.nodes)
 
+	def resolve_conflicts(self,shard=None):
+		return self.blockchain.resolve_conflicts()
 
+	def get_shards(self):
+		"""
+		None means this node holds the whole namespace
+		"""
+		return None
+
+	def get_head(self):
+		"""
+		Cheap summary of the ledger, used by read replicas to decide
+		whether they need to pull the full chain again
+		"""
+		response = {
+		'node_identifier': self.node_identifier,
+		'length': len(self.blockchain.chain),
+		'last_hash': self.blockchain.hash(self.blockchain.last_block),
+		'nodes': list(self.blockchain.nodes)
+		}
+		return response
+
+
+class WriterError(Exception):
+	def __init__(self, message, status_code=502, retry_after=None):
+		"""
+		Raised by a replica when the writer refuses or fails a request
+
+		:param status_code: what the replica should answer its own caller
+		:param retry_after: the writer's Retry-After header, if any
+		"""
+		super().__init__(message)
+		self.status_code = status_code
+		self.retry_after = retry_after
+
+
+class dns_replica(dns_layer):
+	def __init__(self, writer, transport=requests, timeout=5, **layer_args):
+		"""
+		A read-only copy of the ledger held by a writer node.
+		Lookups are answered from the local copy, everything that
+		changes the ledger is forwarded to the writer.
+
+		:param writer: address (host:port) of the writer node
+		:param timeout: seconds to wait for the writer on every call
+		"""
+		super().__init__(node_identifier = None, transport = transport, **layer_args)
+		self.writer = writer
+		self.timeout = timeout
+		# address of the client whose request this thread is serving
+		self.local = threading.local()
+
+	def set_client(self, addr):
+		"""
+		Remember who the current request comes from, writes forwarded
+		for it carry the address so the writer rate limits that client
+		and not the replica
+		"""
+		self.local.client = addr
+
+	def call_writer(self, method, path, expected, forward=False, **kwargs):
+		"""
+		Send a request to the writer and check its status
+
+		:param expected: status codes counting as success
+		:param forward: send on behalf of the current client, the
+		replica's own sync traffic is sent without it
+		:return: the writer's response
+		:raises WriterError: if the writer is unreachable, too slow
+		(status 504) or answers with any other status
+		"""
+		client = getattr(self.local, 'client', None)
+		if forward and client is not None:
+			kwargs['headers'] = {'X-Forwarded-For': client}
+		try:
+			response = getattr(self.transport, method)(f'http://{self.writer}{path}',
+				timeout=self.timeout, **kwargs)
+		except requests.exceptions.Timeout as e:
+			raise WriterError(f'Writer timed out: {e}', 504)
+		except requests.exceptions.RequestException as e:
+			raise WriterError(f'Writer unreachable: {e}')
+
+		if response.status_code not in expected:
+			raise WriterError(f'Writer answered {path} with {response.status_code}',
+				response.status_code, response.headers.get('Retry-After'))
+		return response
+
+	def sync(self):
+		"""
+		Pull the chain from the writer if it moved since our last sync.
+		The chain is swapped in with a single assignment so concurrent
+		lookups keep iterating over the old list.
+
+		:return: True if our chain was replaced, False if not
+		:raises WriterError: if the writer did not answer with the chain
+		"""
+		head = self.call_writer('get', '/nodes/head', (200,)).json()
+		self.node_identifier = head['node_identifier']
+		self.blockchain.node_identifier = head['node_identifier']
+		self.blockchain.nodes = set(head['nodes'])
+
+		if head['length'] == len(self.blockchain.chain) and \
+			head['last_hash'] == self.blockchain.hash(self.blockchain.last_block):
+			return False
+
+		response = self.call_writer('get', '/nodes/chain', (200,))
+		self.blockchain.replace_chain(response.json()['chain'])
+		return True
+
+	def sync_after_write(self):
+		"""
+		Catch up right after a write the writer accepted. A failure here
+		must not turn that write into an error, the sync thread retries.
+		"""
+		try:
+			self.sync()
+		except WriterError:
+			logger.warning('Replica sync after write failed', exc_info=True)
+
+	def new_entry(self,hostname,ip,port):
+		entry = {'hostname':hostname, 'ip':ip, 'port':port}
+		self.call_writer('post', '/dns/new', (201,), forward=True, json={'entry':entry})
+		self.sync_after_write()
+
+	def mine_block(self):
+		self.call_writer('get', '/debug/force_block', (200,), forward=True)
+		self.sync_after_write()
+		return self.blockchain.last_block['proof']
+
+	def dump_buffer(self):
+		return self.call_writer('get', '/debug/dump_buffer', (200,), forward=True).json()
+
+	def register_node(self,addr):
+		self.call_writer('post', '/nodes/new', (201,), forward=True, json={'nodes':[addr]})
+		self.sync_after_write()
+
+	def resolve_conflicts(self,shard=None):
+		self.call_writer('get', '/nodes/resolve', (200,), forward=True)
+
+
+class sharded_dns_layer(object):
+	def __init__(self, node_identifier, shard_map, shards, transport=requests, **layer_args):
+		"""
+		A node holding only some shards of the namespace. Every shard
+		is its own dns_layer with its own sub-chain, lookups and new
+		entries for other shards are routed to peers that hold them.
+
+		:param shard_map: ShardMap deciding which shard a hostname is in
+		:param shards: names of the shards this node subscribes to
+		:param layer_args: passed on to the dns_layer of every shard
+		:raises ValueError: if shard_map cannot produce one of shards
+		"""
+		shard_map.check_shards(shards)
+		self.shard_map = shard_map
+		self.transport = transport
+		self.node_identifier = node_identifier
+		self.shards = {shard: dns_layer(node_identifier, transport, shard, **layer_args) for shard in shards}
+		# shard -> set of peers holding it, None collects peers holding everything
+		self.routes = {}
+		self.nodes = set()
+		# peers whose shards we could not learn yet -> when to ask again
+		self.undiscovered = {}
+		self.DISCOVERY_RETRY = 10
+
+	def call_peer(self,node,method,path,**kwargs):
+		"""
+		Send a request to a peer, an unreachable peer is logged and
+		skipped so the caller can fail over to the next one
+
+		:return: the peer's response, or None if it could not be reached
+		"""
+		try:
+			with phase('neighbour'):
+				return getattr(self.transport, method)(f'http://{node}{path}', **kwargs)
+		except requests.exceptions.RequestException as e:
+			logger.warning('Peer %s unreachable: %s', node, e)
+			return None
+
+	@staticmethod
+	def should_fail_over(response):
+		"""
+		Only unreachable, overloaded or failing peers are worth asking
+		the next peer instead, any other answer is final. Retrying a
+		definite miss on every peer would multiply random-subdomain floods.
+		"""
+		return response is None or response.status_code == 429 or response.status_code >= 500
+
+	def local_shard(self,hostname):
+		"""
+		:return: the dns_layer holding hostname, or None if it is foreign
+		"""
+		return self.shards.get(self.shard_map.shard_of(hostname))
+
+	def peers_for(self,shard):
+		self.discover_pending()
+		return list(self.routes.get(shard, ())) + list(self.routes.get(None, ()))
+
+	def lookup(self,hostname):
+		layer = self.local_shard(hostname)
+		if layer is not None:
+			return layer.lookup(hostname)
+
+		for node in self.peers_for(self.shard_map.shard_of(hostname)):
+			response = self.call_peer(node, 'post', '/dns/request', json={'hostname':hostname})
+			if response is not None and response.status_code == 200:
+				return (response.json()['ip'],response.json()['port'])
+			if not self.should_fail_over(response):
+				break
+		raise LookupError('No existing entry matching hostname')
+
+	def batch_lookup(self,hostnames):
+		"""
+		Local shards are scanned once each, foreign shards cost one
+		batch request to a peer holding them
+		"""
+		by_shard = {}
+		for hostname in hostnames:
+			by_shard.setdefault(self.shard_map.shard_of(hostname), []).append(hostname)
+
+		found = {}
+		for shard, names in by_shard.items():
+			if shard in self.shards:
+				found.update(self.shards[shard].batch_lookup(names))
+				continue
+			for node in self.peers_for(shard):
+				response = self.call_peer(node, 'post', '/dns/batch', json={'hostnames':names})
+				if response is not None and response.status_code == 200:
+					for result in response.json()['results']:
+						if 'error' not in result:
+							found[result['hostname']] = (result['ip'],result['port'])
+					break
+				if not self.should_fail_over(response):
+					break
+		return found
+
+	def reverse_lookup(self,ip):
+		"""
+		Only covers the shards held locally
+		"""
+		hostnames = []
+		for layer in self.shards.values():
+			hostnames.extend(layer.reverse_index.lookup(ip))
+		if not hostnames:
+			raise LookupError('No existing entry matching ip')
+		return hostnames
+
+	def reverse_lookup_network(self,network):
+		entries = []
+		for layer in self.shards.values():
+			entries.extend(layer.reverse_lookup_network(network))
+		return entries
+
+	def new_entry(self,hostname,ip,port):
+		layer = self.local_shard(hostname)
+		if layer is not None:
+			return layer.new_entry(hostname,ip,port)
+
+		shard = self.shard_map.shard_of(hostname)
+		entry = {'hostname':hostname, 'ip':ip, 'port':port}
+		for node in self.peers_for(shard):
+			response = self.call_peer(node, 'post', '/dns/new', json={'entry':entry})
+			if response is not None and response.status_code == 201:
+				return
+			if not self.should_fail_over(response):
+				raise LookupError(f'Node {node} refused the entry with {response.status_code}')
+		raise LookupError(f'No reachable node holds shard {shard}')
+
+	def mine_block(self):
+		return {shard: layer.mine_block() for shard, layer in self.shards.items()}
+
+	def dump_chain(self,shard=None):
+		"""
+		:param shard: which sub-chain to dump, all of them if None.
+		The result for None is keyed by shard, it is not a chain peers
+		can sync with (server.py refuses it on /nodes/chain)
+		"""
+		if shard is not None:
+			return self.shards[shard].dump_chain()
+		return {shard: layer.dump_chain() for shard, layer in self.shards.items()}
+
+	def dump_buffer(self):
+		return {shard: layer.dump_buffer() for shard, layer in self.shards.items()}
+
+	def get_chain_quota(self):
+		return {shard: layer.get_chain_quota() for shard, layer in self.shards.items()}
+
+	def get_filter_stats(self):
+		return {shard: layer.get_filter_stats() for shard, layer in self.shards.items()}
+
+	def register_node(self,addr):
+		"""
+		Ask the new node which shards it holds, and only share the
+		sub-chains we have in common with it
+		"""
+		self.nodes.add(addr)
+		response = self.call_peer(addr, 'get', '/nodes/shards')
+		if response is None or response.status_code != 200:
+			# try again later, lookups still fail over to other peers
+			self.undiscovered[addr] = monotonic() + self.DISCOVERY_RETRY
+			return
+		self.undiscovered.pop(addr, None)
+
+		shards = response.json()['shards']
+		if shards is None:
+			self.routes.setdefault(None, set()).add(addr)
+			return
+
+		for shard in shards:
+			self.routes.setdefault(shard, set()).add(addr)
+			if shard in self.shards:
+				self.shards[shard].register_node(addr)
+
+	def discover_pending(self):
+		"""
+		Ask again which shards the peers that were unreachable when
+		they registered hold, at most every DISCOVERY_RETRY seconds
+		"""
+		now = monotonic()
+		for addr, retry_at in list(self.undiscovered.items()):
+			if retry_at <= now:
+				self.register_node(addr)
+
+	def get_network_size(self):
+		return len(self.nodes)
 
+	def resolve_conflicts(self,shard=None):
+		if shard is not None:
+			return self.shards[shard].resolve_conflicts()
+		return any([layer.resolve_conflicts() for layer in self.shards.values()])
 
+	def get_shards(self):
+		return sorted(self.shards)
 
+	def get_head(self):
+		return {shard: layer.get_head() for shard, layer in self.shards.items()}
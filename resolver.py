@@ -1,12 +1,18 @@
 # extracted and modified from https://gist.github.com/samuelcolvin/ca8b429504c96ee738d62a798172b046
 
+import logging
 from datetime import datetime
 from time import sleep
 
-from dnslib import DNSLabel, QTYPE, RD, RR
-from dnslib import A, AAAA, CNAME, MX, NS, SOA, TXT
+from dnslib import DNSLabel, QTYPE, RCODE, RD, RR
+from dnslib import A, AAAA, CNAME, MX, NS, PTR, SOA, TXT
 from dnslib.server import DNSServer
 
+from admission import Overloaded
+from reverse_index import reverse_pointer_to_ip
+
+logger = logging.getLogger(__name__)
+
 EPOCH = datetime(1970, 1, 1)
 SERIAL = int((datetime.utcnow() - EPOCH).total_seconds())
 
@@ -16,6 +22,7 @@ TYPE_LOOKUP = {
     CNAME: QTYPE.CNAME,
     MX: QTYPE.MX,
     NS: QTYPE.NS,
+    PTR: QTYPE.PTR,
     SOA: QTYPE.SOA,
     TXT: QTYPE.TXT,
 }
@@ -69,18 +76,62 @@ class Record:
         return '{} {}'.format(QTYPE[self._rtype], self.kwargs)
 
 class Resolver:
-    def __init__(self,dns_layer):
+    def __init__(self,dns_layer,admission=None):
+        """
+        :param admission: optional AdmissionController, queries over
+        its limits are answered with REFUSED
+        """
         self.dns_layer = dns_layer
+        self.admission = admission
+        # static zones served next to the ledger, none by default
+        self.zones = {}
+
+    def resolve_ptr(self, request, reply):
+        """
+        answers in-addr.arpa / ip6.arpa queries from the ledger's
+        reverse index, so the cost does not depend on the chain length
+        """
+        ip = reverse_pointer_to_ip(request.q.qname)
+        if ip is None:
+            return False
+        try:
+            hostnames = self.dns_layer.reverse_lookup(ip)
+        except LookupError:
+            # no entry points at ip, so the name does not exist at all
+            reply.header.rcode = RCODE.NXDOMAIN
+            return True
+        if request.q.qtype in (QTYPE.PTR, QTYPE.ANY):
+            for hostname in hostnames:
+                reply.add_answer(Record(PTR, hostname).as_rr(request.q.qname))
+        return True
 
     def resolve(self, request, handler):
+        if self.admission is None:
+            return self.answer(request)
+
+        try:
+            self.admission.acquire('read', handler.client_address[0])
+        except Overloaded:
+            reply = request.reply()
+            reply.header.rcode = RCODE.REFUSED
+            return reply
+        try:
+            return self.answer(request)
+        finally:
+            self.admission.release('read')
+
+    def answer(self, request):
         reply = request.reply()
         # print(request.q.qname)
-        
+
+        if self.resolve_ptr(request, reply):
+            return reply
+
         zone = self.zones.get(request.q.qname)
         if zone is not None:
             for zone_records in zone:
                 rr = zone_records.try_rr(request.q)
-                print(rr)
+                logger.debug('Answering %s', rr)
                 rr and reply.add_answer(rr)
         else:
             # no direct zone so look for an SOA record for a higher level zone
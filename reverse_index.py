@@ -0,0 +1,143 @@
+"""
+Reverse (ip -> hostnames) index over the ledger.
+
+Follows the same rule as dns_layer.lookup: the first transaction for a
+hostname is the one that counts, later ones for the same hostname are
+ignored. Exact addresses are kept in a dict, and a binary radix tree per
+address family answers CIDR prefix queries.
+"""
+
+import ipaddress
+
+
+def normalize_ip(ip):
+	"""
+	Canonical text form of an address so that e.g. IPv6 spellings match.
+	Entries that are not valid addresses are kept as they are.
+	"""
+	try:
+		return str(ipaddress.ip_address(str(ip)))
+	except ValueError:
+		return str(ip)
+
+
+def reverse_pointer_to_ip(name):
+	"""
+	Turn a PTR query name into the address it points at
+
+	:param name: e.g. '4.3.2.1.in-addr.arpa' or '...ip6.arpa'
+	:return: the address as a string, or None if name is not a reverse name
+	"""
+	labels = str(name).rstrip('.').lower().split('.')
+
+	if labels[-2:] == ['in-addr', 'arpa'] and len(labels) == 6:
+		ip = '.'.join(reversed(labels[:4]))
+	elif labels[-2:] == ['ip6', 'arpa'] and len(labels) == 34:
+		nibbles = ''.join(reversed(labels[:32]))
+		ip = ':'.join(nibbles[i:i + 4] for i in range(0, 32, 4))
+	else:
+		return None
+
+	try:
+		return str(ipaddress.ip_address(ip))
+	except ValueError:
+		return None
+
+
+class RadixTree(object):
+	def __init__(self):
+		"""
+		Binary trie over address bits. Each node is a list
+		[child for bit 0, child for bit 1, hostnames stored at this node]
+		"""
+		self.root = [None, None, []]
+
+	@staticmethod
+	def bits(address, length):
+		value = int(address)
+		width = address.max_prefixlen
+		for i in range(length):
+			yield (value >> (width - 1 - i)) & 1
+
+	def insert(self, address, hostname):
+		node = self.root
+		for bit in self.bits(address, address.max_prefixlen):
+			if node[bit] is None:
+				node[bit] = [None, None, []]
+			node = node[bit]
+		node[2].append(hostname)
+
+	def collect(self, network):
+		"""
+		:param network: an ipaddress network
+		:return: every hostname stored under the prefix
+		"""
+		node = self.root
+		for bit in self.bits(network.network_address, network.prefixlen):
+			node = node[bit]
+			if node is None:
+				return []
+
+		hostnames = []
+		stack = [node]
+		while stack:
+			node = stack.pop()
+			hostnames.extend(node[2])
+			# push bit 1 first so addresses come out in ascending order
+			stack.extend(child for child in (node[1], node[0]) if child is not None)
+		return hostnames
+
+
+class ReverseIndex(object):
+	def __init__(self):
+		self.rebuild([])
+
+	def rebuild(self, chain):
+		"""
+		Build the index from scratch. The state is a single tuple
+		(hostname -> ip, ip -> hostnames, radix trees per ip version)
+		swapped in at the end, so lookups running meanwhile keep using
+		the old one
+		"""
+		state = ({}, {}, {4: RadixTree(), 6: RadixTree()})
+		for block in chain:
+			self._add_block(state, block)
+		self._state = state
+
+	def add_block(self, block):
+		self._add_block(self._state, block)
+
+	@staticmethod
+	def _add_block(state, block):
+		hostnames, by_ip, trees = state
+		for transaction in block['transactions']:
+			hostname = transaction.get('hostname')
+			if hostname is None or hostname in hostnames:
+				continue
+
+			ip = normalize_ip(transaction['ip'])
+			hostnames[hostname] = ip
+			by_ip.setdefault(ip, []).append(hostname)
+			try:
+				address = ipaddress.ip_address(ip)
+			except ValueError:
+				continue
+			trees[address.version].insert(address, hostname)
+
+	def lookup(self, ip):
+		"""
+		:param ip: string, target ip we are looking for
+		:return: list of hostnames pointing at ip
+		"""
+		hostnames, by_ip, trees = self._state
+		return list(by_ip.get(normalize_ip(ip), []))
+
+	def lookup_network(self, network):
+		"""
+		:param network: string in CIDR notation, e.g. '10.0.0.0/8'
+		:return: list of (hostname, ip) for every address inside network
+		:raises ValueError: if network is not a valid CIDR prefix
+		"""
+		hostnames, by_ip, trees = self._state
+		network = ipaddress.ip_network(network, strict=False)
+		return [(hostname, hostnames[hostname]) for hostname in trees[network.version].collect(network)]
@@ -0,0 +1,235 @@
+"""
+Multi-worker serving mode for a DNS node.
+
+One writer process owns the ledger (it is a regular server.py node
+listening on an internal port). A pool of read replica processes share
+the public listening socket, answer lookups from their own copy of the
+chain and forward anything that changes the ledger to the writer.
+
+Every process serves server.app with werkzeug's threaded server, which
+werkzeug documents as a development server: one thread per connection,
+no request size or header timeouts, no protection against slow clients.
+This mode spreads load over cores and keeps the writer/replica split,
+it does not harden the HTTP layer. Facing untrusted clients, put a
+reverse proxy (nginx, haproxy) in front of the public port.
+
+Usage:
+    python ./serve.py -c serve.ini
+"""
+
+import configparser
+import logging
+import multiprocessing
+import signal
+import socket
+import sys
+import threading
+from time import sleep
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+import diagnostics
+from bloom import check_filter_args
+import dns
+import server
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'server': {
+        'host': '127.0.0.1',
+        'port': '5000',
+        'workers': str(multiprocessing.cpu_count()),
+        'keepalive_timeout': '5',
+        'graceful_timeout': '10',
+    },
+    'writer': {
+        'host': '127.0.0.1',
+        'port': '5100',
+        'trusted_proxies': '127.0.0.1',
+    },
+    'replica': {
+        'sync_interval': '0.5',
+        'writer_timeout': '5',
+    },
+    'filter': {
+        'capacity': '100000',
+        'error_rate': '0.001',
+    },
+    'logging': {
+        'level': 'WARNING',
+        'rate': '10',
+    },
+}
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 handler so clients can reuse connections.
+    The socket timeout bounds how long an idle connection holds a thread,
+    which is also how long a graceful shutdown may have to wait for it.
+    """
+    protocol_version = 'HTTP/1.1'
+
+
+def load_config(path):
+    config = configparser.ConfigParser()
+    config.read_dict(DEFAULTS)
+    if path:
+        with open(path) as f:
+            config.read_file(f)
+    return config
+
+
+def filter_args(config):
+    return {
+        'filter_capacity': config['filter'].getint('capacity'),
+        'filter_error_rate': config['filter'].getfloat('error_rate'),
+    }
+
+
+def bind_socket(host, port):
+    """
+    Bind the public socket once in the parent, every replica inherits it
+    and accepts on it, so the kernel spreads connections over workers.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(socket.SOMAXCONN)
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_until_stopped(httpd):
+    """
+    Serve until SIGTERM/SIGINT, then stop accepting and wait for the
+    in-flight requests to finish before returning.
+    """
+    httpd.daemon_threads = False
+    httpd.block_on_close = True
+
+    def stop(signum, frame):
+        threading.Thread(target=httpd.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    httpd.serve_forever()
+    httpd.server_close()
+
+
+def run_writer(config):
+    host = config['writer']['host']
+    port = config['writer'].getint('port')
+    KeepAliveRequestHandler.timeout = config['server'].getfloat('keepalive_timeout')
+    # the replicas' addresses, writes they forward are rate limited per original client
+    server.TRUSTED_PROXIES = set(config['writer']['trusted_proxies'].split())
+    server.dns_resolver = dns.dns_layer(node_identifier = server.node_identifier, **filter_args(config))
+
+    httpd = make_server(host, port, server.app, threaded=True,
+        request_handler=KeepAliveRequestHandler)
+    serve_until_stopped(httpd)
+
+
+def sync_forever(replica, interval):
+    while True:
+        try:
+            replica.sync()
+        except Exception:
+            # writer not up yet, restarting or refusing us: keep serving
+            # the old copy and try again, this thread must never die
+            logger.warning('Replica sync failed', exc_info=True)
+        sleep(interval)
+
+
+def run_replica(config, fd):
+    host = config['server']['host']
+    port = config['server'].getint('port')
+    writer = f"{config['writer']['host']}:{config['writer']['port']}"
+    KeepAliveRequestHandler.timeout = config['server'].getfloat('keepalive_timeout')
+
+    # the routes in server.py read this module global at request time
+    server.dns_resolver = dns.dns_replica(writer,
+        timeout=config['replica'].getfloat('writer_timeout'), **filter_args(config))
+    t = threading.Thread(target=sync_forever,
+        args=(server.dns_resolver, config['replica'].getfloat('sync_interval')),
+        daemon=True)
+    t.start()
+
+    httpd = make_server(host, port, server.app, threaded=True,
+        request_handler=KeepAliveRequestHandler, fd=fd)
+    serve_until_stopped(httpd)
+
+
+def main(config):
+    diagnostics.configure_logging(config['logging']['level'].upper(), config['logging'].getint('rate'))
+    ctx = multiprocessing.get_context('fork')
+    sock = bind_socket(config['server']['host'], config['server'].getint('port'))
+    graceful_timeout = config['server'].getfloat('graceful_timeout')
+
+    writer = ctx.Process(target=run_writer, args=(config,), name='writer')
+    writer.start()
+
+    def spawn_replica(i):
+        p = ctx.Process(target=run_replica, args=(config, sock.fileno()), name=f'replica-{i}')
+        p.start()
+        return p
+
+    replicas = [spawn_replica(i) for i in range(config['server'].getint('workers'))]
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.set())
+
+    exitcode = 0
+    while not stopping.is_set():
+        if not writer.is_alive():
+            # the ledger lived in the writer's memory, a new writer would
+            # start from an empty chain and the replicas would sync to it
+            logger.error("writer exited with %s, shutting down", writer.exitcode)
+            exitcode = 1
+            break
+        # respawn replicas that died, the ledger lives in the writer
+        for i, p in enumerate(replicas):
+            if not p.is_alive() and not stopping.is_set():
+                logger.warning("%s exited with %s, restarting", p.name, p.exitcode)
+                replicas[i] = spawn_replica(i)
+        stopping.wait(1)
+
+    # stop the replicas first so no new writes reach the writer
+    for p in replicas:
+        p.terminate()
+    for p in replicas:
+        p.join(graceful_timeout)
+        if p.is_alive():
+            p.kill()
+
+    writer.terminate()
+    writer.join(graceful_timeout)
+    if writer.is_alive():
+        writer.kill()
+    sock.close()
+    return exitcode
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--config', default=None, help='path to the config file')
+    parser.add_argument('-p', '--port', default=None, type=int, help='public port, overrides the config file')
+    parser.add_argument('-w', '--workers', default=None, type=int, help='number of replica workers, overrides the config file')
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.port is not None:
+        config['server']['port'] = str(args.port)
+    if args.workers is not None:
+        config['server']['workers'] = str(args.workers)
+    try:
+        layer_args = filter_args(config)
+        check_filter_args(layer_args['filter_capacity'], layer_args['filter_error_rate'])
+    except ValueError as e:
+        parser.error(str(e))
+
+    sys.exit(main(config))
@@ -1,11 +1,14 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
 from flask_cors import CORS
 import json
 import dns
+from sharding import SCHEMES, ShardMap
 from uuid import uuid4
-import threading
-from blockchain import Blockchain  # adjust if the file has a different name
-import uuid
+from time import perf_counter
+
+import diagnostics
+from bloom import check_filter_args
+from admission import AdmissionController, Overloaded, RequestClass, WorkQueue, retry_after_header
 
 
 """
@@ -26,6 +29,131 @@ node_identifier = str(uuid4()).replace('-', '')
 # Instantiate the DNS resolver object
 dns_resolver = dns.dns_layer(node_identifier = node_identifier)
 
+# the longest a single /debug/profile call may sample for
+MAX_PROFILE_SECONDS = 60
+
+profiler = diagnostics.SamplingProfiler()
+slow_requests = diagnostics.SlowRequestLog()
+
+# which admission class every route belongs to, anything else is a read
+REQUEST_CLASSES = {
+    'new_transaction': 'write',
+    'register_node': 'write',
+    'dns_batch_lookup': 'bulk',
+    'dns_batch_stream': 'bulk',
+    'consensus': 'peer',
+    'dump_chain': 'peer',
+    'force_block': 'sync',
+    'dump_buffer': 'admin',
+    'get_chain_quota': 'admin',
+    'profile': 'admin',
+    'get_slow_requests': 'admin',
+    'get_admission_stats': 'admin',
+    'get_filter_stats': 'admin',
+}
+
+# lookups are cheap and never capped in concurrency. Batches and
+# network-wide reverse lookups cost up to MAX_BATCH_SIZE lookups each.
+# Every peer fetches our chain after each broadcast, so the peer class
+# grows with the network instead of being capped. Writes and mining are
+# capped, and all but lookups are shed first when the node gets busy
+admission = AdmissionController({
+    'read': RequestClass(rate=5000, burst=10000, client_rate=500, client_burst=1000, cheap=True),
+    'bulk': RequestClass(rate=20, burst=40, client_rate=5, client_burst=10, concurrency=4),
+    'peer': RequestClass(rate=2, burst=4, client_rate=5, client_burst=10,
+        scale=lambda: dns_resolver.get_network_size()),
+    'write': RequestClass(rate=50, burst=100, client_rate=10, client_burst=20, concurrency=4),
+    'sync': RequestClass(rate=20, burst=40, client_rate=5, client_burst=10, concurrency=2),
+    'admin': RequestClass(rate=5, burst=10, client_rate=2, client_burst=5, concurrency=2),
+}, max_in_flight=64)
+
+# replicas in front of this node (see serve.py). Requests from them are
+# charged to the client named in X-Forwarded-For, and their own sync
+# traffic, sent without it, is not limited at all
+TRUSTED_PROXIES = set()
+
+def classify_request():
+    """
+    :return: the admission class of the current request
+    """
+    if request.endpoint == 'dns_reverse_lookup':
+        # a single ip is one index lookup, a network may cover every entry
+        values = request.get_json(silent=True)
+        if isinstance(values, dict) and 'network' in values:
+            return 'bulk'
+    return REQUEST_CLASSES.get(request.endpoint, 'read')
+
+def background_resolve(shard):
+    """
+    runs a queued resolve under a trace of its own, so its phases
+    (neighbour calls, valid_chain...) show up in /debug/slow_requests
+    """
+    path = '/nodes/resolve' if shard is None else f'/nodes/resolve?shard={shard}'
+    status = 500
+    start = perf_counter()
+    diagnostics.start_trace()
+    try:
+        dns_resolver.resolve_conflicts(shard)
+        status = 200
+    finally:
+        slow_requests.record('BACKGROUND', path, status,
+            perf_counter() - start, diagnostics.stop_trace())
+
+# at most one resolve runs at a time, repeated requests for the same shard coalesce
+resolve_queue = WorkQueue(background_resolve, maxsize=8)
+
+@app.before_request
+def start_request_trace():
+    g.request_start = perf_counter()
+    diagnostics.start_trace()
+
+@app.before_request
+def admit_request():
+    """
+    sheds the request with a 429 before any work is done on it
+    when the node, the route or the client is over its limit
+    """
+    client = request.remote_addr
+    if client in TRUSTED_PROXIES:
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded is None:
+            return
+        client = forwarded.split(',')[0].strip()
+
+    if isinstance(dns_resolver, dns.dns_replica):
+        dns_resolver.set_client(client)
+
+    request_class = classify_request()
+    try:
+        admission.acquire(request_class, client)
+    except Overloaded as e:
+        response = jsonify(str(e))
+        response.headers['Retry-After'] = retry_after_header(e)
+        return response, 429
+    g.request_class = request_class
+
+@app.teardown_request
+def release_request(exc):
+    if 'request_class' in g:
+        admission.release(g.pop('request_class'))
+
+@app.after_request
+def record_request_trace(response):
+    duration = perf_counter() - g.request_start
+    slow_requests.record(request.method, request.full_path.rstrip('?'),
+        response.status_code, duration, diagnostics.stop_trace())
+    return response
+
+@app.errorhandler(dns.WriterError)
+def writer_error(e):
+    """
+    a replica passes the writer's refusal on to its own caller
+    """
+    response = jsonify(str(e))
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = e.retry_after
+    return response, e.status_code
+
 @app.route('/debug/alive',methods=['GET'])
 def check_alive():
     response = 'The node is alive'
@@ -64,8 +192,12 @@ def new_transaction():
     for value in values:
         # print(value)
         if all(k in values[value] for k in required):
-            value = values[value]
-            dns_resolver.new_entry(value['hostname'],value['ip'],value['port'])
+            entry = values[value]
+            try:
+                dns_resolver.new_entry(entry['hostname'],entry['ip'],entry['port'])
+            except LookupError:
+                # sharded node that knows no peer holding the hostname's shard
+                bad_entries.append(value)
         else:
             bad_entries.append(value)
 
@@ -99,14 +231,150 @@ def dns_lookup():
 
     return jsonify(response), return_code
 
+# record types a batch query may ask for and the address family each one
+# answers with, None for any. The ledger only holds address records
+BATCH_RECORD_TYPES = {'A': 4, 'AAAA': 6, 'ANY': None}
+# most hostnames in one /dns/batch request, larger batches go to /dns/batch/stream
+MAX_BATCH_SIZE = 1000
+# number of hostnames resolved per pass over the chain when streaming,
+# at most MAX_BATCH_SIZE since a sharded node forwards chunks as batches
+BATCH_STREAM_CHUNK = 1000
+
+def parse_batch(values):
+    """
+    Turns the body of a batch request into a list of (hostname, type).
+    Queries are either plain hostnames or {"hostname":..., "type":...}
+
+    :return: the list of queries, or None if the body is malformed
+    """
+    if not isinstance(values, dict) or not isinstance(values.get('hostnames'), list):
+        return None
+
+    queries = []
+    for query in values['hostnames']:
+        if isinstance(query, str):
+            queries.append((query, 'A'))
+        elif isinstance(query, dict) and isinstance(query.get('hostname'), str):
+            queries.append((query['hostname'], str(query.get('type', 'A')).upper()))
+        else:
+            return None
+    return queries
+
+def address_family(ip):
+    """
+    6 for IPv6 addresses, 4 for anything else. Every IPv6 spelling has a
+    ':' and no IPv4 one does, entries that are not valid addresses
+    keep being served as A records
+    """
+    return 6 if ':' in str(ip) else 4
+
+def batch_results(queries):
+    """
+    Resolves a list of queries with one pass over the chain
+
+    :return: a list of per-name results, in the order of the queries
+    """
+    found = dns_resolver.batch_lookup(
+        hostname for hostname, rtype in queries if rtype in BATCH_RECORD_TYPES)
+
+    results = []
+    for hostname, rtype in queries:
+        result = {'hostname': hostname, 'type': rtype}
+        if rtype not in BATCH_RECORD_TYPES:
+            result['error'] = "Unsupported record type"
+        elif hostname not in found:
+            result['error'] = "No existing entry"
+        elif BATCH_RECORD_TYPES[rtype] not in (None, address_family(found[hostname][0])):
+            result['error'] = "No record of this type"
+        else:
+            result['ip'], result['port'] = found[hostname]
+        results.append(result)
+    return results
+
+@app.route('/dns/batch',methods=['POST'])
+def dns_batch_lookup():
+    """
+    resolves a list of hostnames in a single request, every name
+    gets either an ip and port or an error in the response
+    """
+    queries = parse_batch(request.get_json())
+    if queries is None:
+        return 'Missing values', 400
+    if len(queries) > MAX_BATCH_SIZE:
+        return f'At most {MAX_BATCH_SIZE} hostnames per batch, use /dns/batch/stream', 413
+
+    response = {'results': batch_results(queries)}
+    return jsonify(response), 200
+
+@app.route('/dns/batch/stream',methods=['POST'])
+def dns_batch_stream():
+    """
+    same as /dns/batch but for very large batches, results are streamed
+    back as one JSON object per line while the chain is scanned in chunks
+    """
+    queries = parse_batch(request.get_json())
+    if queries is None:
+        return 'Missing values', 400
+
+    def generate():
+        for start in range(0, len(queries), BATCH_STREAM_CHUNK):
+            for result in batch_results(queries[start:start + BATCH_STREAM_CHUNK]):
+                yield json.dumps(result) + '\n'
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    # the body is produced after teardown_request, keep the admission
+    # slot until the server closes the stream instead
+    request_class = g.pop('request_class', None)
+    if request_class is not None:
+        response.call_on_close(lambda: admission.release(request_class))
+    return response
+
+@app.route('/dns/reverse',methods=['POST'])
+def dns_reverse_lookup():
+    """
+    finds the hostnames pointing at an ip, or at any address
+    inside a CIDR prefix when 'network' is given instead
+    """
+    values = request.get_json()
+    if not isinstance(values, dict) or not ('ip' in values or 'network' in values):
+        return 'Missing values', 400
+
+    if 'network' in values:
+        try:
+            entries = dns_resolver.reverse_lookup_network(values['network'])
+        except ValueError:
+            return 'Invalid network', 400
+        response = [{'hostname': hostname, 'ip': ip} for hostname, ip in entries]
+        return jsonify(response), 200
+
+    try:
+        response = {
+        'ip': values['ip'],
+        'hostnames': dns_resolver.reverse_lookup(values['ip'])
+        }
+        return_code = 200
+    except LookupError:
+        response = "No existing entry"
+        return_code = 401
+
+    return jsonify(response), return_code
+
 @app.route('/nodes/resolve',methods=['GET'])
 def consensus():
     """
     triggers the blockchain to check chain against other neighbors'
     chain, and uses the longest chain to achieve consensus
     """
-    t = threading.Thread(target=dns_resolver.blockchain.resolve_conflicts)
-    t.start()
+    shard = request.args.get('shard')
+    if shard is not None and shard not in (dns_resolver.get_shards() or [shard]):
+        return 'Shard not held by this node', 404
+
+    try:
+        resolve_queue.submit(shard)
+    except Overloaded as e:
+        response = jsonify(str(e))
+        response.headers['Retry-After'] = retry_after_header(e)
+        return response, 429
 
     # if replaced:
     # 	response = {
@@ -124,7 +392,27 @@ def consensus():
 @app.route('/debug/dump_chain',methods=['GET'])
 @app.route('/nodes/chain',methods=['GET'])
 def dump_chain():
-    response = dns_resolver.dump_chain()
+    shard = request.args.get('shard')
+    if shard is not None and shard not in (dns_resolver.get_shards() or [shard]):
+        return 'Shard not held by this node', 404
+    if shard is None and dns_resolver.get_shards() is not None and request.path == '/nodes/chain':
+        # a sharded node has no single chain an unsharded peer could sync with
+        return 'This node is sharded, pass ?shard=', 400
+
+    response = dns_resolver.dump_chain(shard)
+    return jsonify(response), 200
+
+@app.route('/nodes/shards',methods=['GET'])
+def get_shards():
+    """
+    which shards this node holds, null if it holds the whole namespace
+    """
+    response = {'shards': dns_resolver.get_shards()}
+    return jsonify(response), 200
+
+@app.route('/nodes/head',methods=['GET'])
+def chain_head():
+    response = dns_resolver.get_head()
     return jsonify(response), 200
 
 @app.route('/debug/dump_buffer',methods=['GET'])
@@ -137,6 +425,48 @@ def force_block():
     response = dns_resolver.mine_block()
     return jsonify(f"New block mined with proof {response}"), 200
 
+@app.route('/debug/profile',methods=['GET'])
+def profile():
+    """
+    samples every thread of this node for ?seconds= (default 10) and
+    returns the stacks in folded format, ready for flamegraph.pl or speedscope
+    """
+    try:
+        seconds = float(request.args.get('seconds', 10))
+    except ValueError:
+        return 'Invalid seconds', 400
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        return f'seconds must be between 0 and {MAX_PROFILE_SECONDS}', 400
+
+    try:
+        response = profiler.profile(seconds)
+    except RuntimeError:
+        return 'A profile is already running', 409
+    return Response(response, mimetype='text/plain')
+
+@app.route('/debug/slow_requests',methods=['GET'])
+def get_slow_requests():
+    """
+    the slowest recent requests, with the time spent in each phase
+    (lookup, quota, proof_of_work, neighbour calls...)
+    """
+    response = slow_requests.slowest(request.args.get('limit', type=int))
+    return jsonify(response), 200
+
+@app.route('/debug/admission',methods=['GET'])
+def get_admission_stats():
+    response = admission.stats()
+    return jsonify(response), 200
+
+@app.route('/debug/filter',methods=['GET'])
+def get_filter_stats():
+    """
+    size, fill and false positive rate of the hostname Bloom filter,
+    and how many lookups it answered without scanning the chain
+    """
+    response = dns_resolver.get_filter_stats()
+    return jsonify(response), 200
+
 @app.route('/debug/get_quota',methods=['GET'])
 def get_chain_quota():
     response = dns_resolver.get_chain_quota()
@@ -149,12 +479,31 @@ if __name__ == '__main__':
     parser = ArgumentParser()
     # default port for DNS should be 53
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    parser.add_argument('--shards', default=None, help='comma separated shards to hold, all of them if omitted')
+    parser.add_argument('--shard-scheme', default='tld', choices=SCHEMES, help='how hostnames are split into shards')
+    parser.add_argument('--shard-count', default=16, type=int, help='number of shards for the hash scheme')
+    parser.add_argument('--log-level', default='WARNING', help='DEBUG, INFO, WARNING or ERROR')
+    parser.add_argument('--filter-capacity', default=100000, type=int, help='hostnames the Bloom filter is sized for')
+    parser.add_argument('--filter-error-rate', default=0.001, type=float, help='target false positive rate of the Bloom filter')
     args = parser.parse_args()
     port = args.port
 
-    node_identifier = str(uuid.uuid4()).replace('-', '')
-    blockchain = Blockchain(node_identifier)
+    diagnostics.configure_logging(args.log_level.upper())
 
+    filter_args = {'filter_capacity': args.filter_capacity, 'filter_error_rate': args.filter_error_rate}
+    try:
+        check_filter_args(args.filter_capacity, args.filter_error_rate)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.shards:
+        try:
+            shard_map = ShardMap(args.shard_scheme, args.shard_count)
+            dns_resolver = dns.sharded_dns_layer(node_identifier, shard_map, args.shards.split(','), **filter_args)
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        dns_resolver = dns.dns_layer(node_identifier = node_identifier, **filter_args)
 
+    # development server only, see serve.py for the multi-worker mode
     app.run(host='127.0.0.1', port=port, debug=True)
 
@@ -0,0 +1,84 @@
+"""
+Partitioning of the hostname namespace into shards.
+
+Every shard is a separate sub-chain, so a node only stores and
+validates the shards it subscribes to. Two schemes are supported:
+'tld' uses the top level domain as the shard, 'hash' places hostnames
+on a consistent hash ring of shard_count shards, so adding a shard only
+moves the names that land on it.
+"""
+
+import bisect
+import hashlib
+from urllib.parse import urlparse
+
+SCHEMES = ('tld', 'hash')
+
+
+class ShardMap(object):
+	def __init__(self, scheme='tld', shard_count=16, virtual_nodes=64):
+		"""
+		:param scheme: 'tld' or 'hash'
+		:param shard_count: number of shards for the 'hash' scheme
+		:param virtual_nodes: points per shard on the hash ring, more
+		points spread names more evenly
+		:raises ValueError: if scheme is unknown or shard_count below 1
+		"""
+		if scheme not in SCHEMES:
+			raise ValueError(f'Unknown sharding scheme {scheme}')
+		if not isinstance(shard_count, int) or shard_count < 1:
+			raise ValueError(f'Shard count must be a positive integer, got {shard_count}')
+		self.scheme = scheme
+		self.shard_count = shard_count
+
+		self.ring = []
+		if scheme == 'hash':
+			self.ring = sorted(
+				(self.point(f'{shard}#{i}'), str(shard))
+				for shard in range(shard_count)
+				for i in range(virtual_nodes))
+			self.points = [point for point, shard in self.ring]
+
+	@staticmethod
+	def point(key):
+		return int(hashlib.sha256(key.encode()).hexdigest()[:16], 16)
+
+	@staticmethod
+	def host(hostname):
+		"""
+		Entries are sometimes stored as urls, only the host part matters
+		"""
+		hostname = str(hostname)
+		if '://' in hostname:
+			hostname = urlparse(hostname).hostname or hostname
+		return hostname.rstrip('.').lower()
+
+	def shard_of(self, hostname):
+		"""
+		:param hostname: string
+		:return: the name of the shard holding hostname
+		"""
+		host = self.host(hostname)
+		if self.scheme == 'tld':
+			return host.rsplit('.', 1)[-1]
+
+		i = bisect.bisect(self.points, self.point(host)) % len(self.ring)
+		return self.ring[i][1]
+
+	def check_shards(self, shards):
+		"""
+		:raises ValueError: if a shard is not a name shard_of can return,
+		a node holding it would hold nothing and forward every name
+		"""
+		for shard in shards:
+			if self.scheme == 'hash':
+				valid = shard in {str(i) for i in range(self.shard_count)}
+				expected = f'0 to {self.shard_count - 1}'
+			else:
+				valid = bool(shard) and shard == self.host(shard) and '.' not in shard
+				expected = 'a lowercase top level domain'
+			if not valid:
+				raise ValueError(f'Invalid shard {shard!r} for the {self.scheme} scheme, expected {expected}')
+
+	def describe(self):
+		return {'scheme': self.scheme, 'shard_count': self.shard_count}
@@ -0,0 +1,307 @@
+"""
+In-process cluster simulator.
+
+Runs many dns_layer nodes in one process. Nodes talk through an
+in-memory transport instead of HTTP, so broadcast_new_block and
+resolve_conflicts run unchanged while the network injects latency,
+loss and partitions. Time is virtual: events are processed in order of
+their scheduled time and nothing actually sleeps.
+
+Dropped messages raise requests.exceptions.ConnectionError, like the
+real transport does, so a node that does not handle an unreachable peer
+aborts its broadcast or consensus round here just as it would in
+production. Those rounds are counted in the report.
+
+Usage:
+    python ./simulator.py -n 100 --writes 50 --lookups 1000 --latency 0.02
+"""
+
+import collections
+import contextlib
+import heapq
+import io
+import itertools
+import json
+import random
+from urllib.parse import urlparse
+
+import requests
+
+import dns
+
+
+class SimResponse(object):
+    """
+    The subset of requests.Response the nodes use
+    """
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.headers = {}
+        self._body = body
+
+    def json(self):
+        return self._body
+
+
+class NodeTransport(object):
+    """
+    Transport handed to a single node, so the network knows who is
+    sending each message
+    """
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+
+    def get(self, url):
+        return self.network.send(self.addr, 'GET', url)
+
+    def post(self, url, json=None):
+        return self.network.send(self.addr, 'POST', url, json)
+
+
+class InMemoryNetwork(object):
+    def __init__(self, latency=0.01, jitter=0.0, loss=0.0, timeout=1.0, seed=None):
+        """
+        :param latency: one way delay of a message, in seconds
+        :param jitter: maximum random delay added on top of latency
+        :param loss: probability that a message is dropped
+        :param timeout: time the sender waits for a dropped message
+        :param seed: seed for the random generator, for repeatable runs
+        """
+        self.latency = latency
+        self.timeout = timeout
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+
+        self.nodes = {}
+        self.groups = None
+
+        self.now = 0.0
+        # time spent waiting on synchronous calls by the event being run
+        self.elapsed = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+
+        self.messages = 0
+        self.bytes = 0
+        self.dropped = 0
+        # events cut short by an unreachable peer, by action name
+        self.aborted = collections.Counter()
+        # encoded chain sizes, keyed by the hash of the last block, which
+        # covers the whole chain through previous_hash
+        self._chain_sizes = {}
+
+    def add_node(self, addr):
+        node = dns.dns_layer(node_identifier = addr, transport = NodeTransport(self, addr))
+        self.nodes[addr] = node
+        return node
+
+    def partition(self, *groups):
+        """
+        Split the network, messages between different groups are dropped.
+        Nodes not listed in any group are isolated.
+        """
+        self.groups = [set(group) for group in groups]
+
+    def heal(self):
+        self.groups = None
+
+    def reachable(self, src, dst):
+        if self.groups is None:
+            return True
+        return any(src in group and dst in group for group in self.groups)
+
+    def delay(self):
+        return self.latency + self.random.uniform(0, self.jitter)
+
+    def schedule(self, delay, action, *args):
+        heapq.heappush(self.events, (self.now + delay, next(self.sequence), action, args))
+
+    def run(self, on_event=None):
+        """
+        Process events until the queue is empty
+
+        :param on_event: called with (start, end) of every event, where
+        end includes the time the event spent on synchronous calls
+        """
+        while self.events:
+            self.now, _, action, args = heapq.heappop(self.events)
+            self.elapsed = 0.0
+            try:
+                result = action(*args)
+            except requests.exceptions.RequestException:
+                self.aborted[action.__name__] += 1
+                result = None
+            if on_event:
+                on_event(self.now, self.now + self.elapsed, result)
+
+    def chain_size(self, chain):
+        key = dns.bc.Blockchain.hash(chain[-1])
+        if key not in self._chain_sizes:
+            self._chain_sizes[key] = len(json.dumps({'chain': chain, 'length': len(chain)}))
+        return self._chain_sizes[key]
+
+    def send(self, src, method, url, body=None):
+        parsed = urlparse(url)
+        dst, path = parsed.netloc, parsed.path
+        self.messages += 1
+        self.bytes += len(url) + (len(json.dumps(body)) if body is not None else 0)
+
+        if dst not in self.nodes or not self.reachable(src, dst) or self.random.random() < self.loss:
+            # the real transport waits for its timeout, then raises
+            self.dropped += 1
+            self.elapsed += self.timeout
+            raise requests.exceptions.ConnectionError(f'{url} unreachable')
+
+        node = self.nodes[dst]
+        if method == 'GET' and path == '/nodes/chain':
+            # synchronous round trip, the caller waits for the response
+            self.elapsed += 2 * self.delay()
+            chain = node.blockchain.chain
+            self.bytes += self.chain_size(chain)
+            # blocks are never mutated once written, a shallow copy is
+            # enough to keep nodes from sharing one list
+            return SimResponse(200, {'chain': list(chain), 'length': len(chain)})
+
+        if method == 'GET' and path == '/nodes/resolve':
+            # server.py resolves on a background thread and answers at once
+            self.schedule(self.elapsed + self.delay(), node.resolve_conflicts)
+            return SimResponse(200, None)
+
+        return SimResponse(404)
+
+
+class ClusterSimulator(object):
+    def __init__(self, size, degree=None, quiet=True, **network_args):
+        """
+        :param size: number of nodes
+        :param degree: number of random neighbours per node, None for a full mesh
+        :param quiet: swallow what the nodes print while running
+        :param network_args: passed on to InMemoryNetwork
+        """
+        self.network = InMemoryNetwork(**network_args)
+        self.quiet = quiet
+        self.addrs = [f'node{i}:5000' for i in range(size)]
+        for addr in self.addrs:
+            self.network.add_node(addr)
+
+        with self.silenced():
+            for addr in self.addrs:
+                others = [a for a in self.addrs if a != addr]
+                if degree is not None:
+                    others = self.network.random.sample(others, min(degree, len(others)))
+                for other in others:
+                    self.network.nodes[addr].register_node(other)
+
+        self.hostnames = []
+        self.mined = set()
+        self.lookups = 0
+        self.lookup_misses = 0
+        self.last_write = 0.0
+        self.last_change = 0.0
+
+    def silenced(self):
+        if self.quiet:
+            return contextlib.redirect_stdout(io.StringIO())
+        return contextlib.nullcontext()
+
+    def write(self, addr, hostname, ip, port):
+        node = self.network.nodes[addr]
+        length = len(node.blockchain.chain)
+        self.hostnames.append(hostname)
+        self.last_write = self.network.now
+        try:
+            node.new_entry(hostname, ip, port)
+        finally:
+            # every block mined here, to count how many got orphaned,
+            # also when the broadcast after mining was aborted
+            for block in node.blockchain.chain[length:]:
+                self.mined.add((block['index'], node.blockchain.hash(block)))
+
+    def read(self, addr, hostname):
+        self.lookups += 1
+        try:
+            self.network.nodes[addr].lookup(hostname)
+        except LookupError:
+            self.lookup_misses += 1
+
+    def on_event(self, start, end, result):
+        # resolve_conflicts returns True when the chain was replaced
+        if result is True:
+            self.last_change = max(self.last_change, end)
+
+    def workload(self, writes, lookups, write_interval, lookup_interval):
+        """
+        Schedule writes to random nodes every write_interval seconds and
+        lookups of already written names every lookup_interval seconds
+        """
+        rand = self.network.random
+        for i in range(writes):
+            addr = rand.choice(self.addrs)
+            hostname = f'host{i}.example.com'
+            ip = '.'.join(str(rand.randint(1, 254)) for _ in range(4))
+            self.network.schedule(i * write_interval, self.write, addr, hostname, ip, rand.randint(1, 65535))
+
+        for i in range(lookups):
+            addr = rand.choice(self.addrs)
+            index = min(int(i * lookup_interval / write_interval), writes - 1)
+            self.network.schedule(i * lookup_interval, self.read, addr, f'host{index}.example.com')
+
+    def run(self, writes=10, lookups=100, write_interval=0.1, lookup_interval=0.01):
+        """
+        Drive a workload to completion and report how the cluster behaved
+
+        :return: a dict of metrics
+        """
+        self.workload(writes, lookups, write_interval, lookup_interval)
+
+        with self.silenced():
+            self.network.run(self.on_event)
+
+        chains = [node.blockchain.chain for node in self.network.nodes.values()]
+        heads = {dns.bc.Blockchain.hash(chain[-1]) for chain in chains}
+        longest = max(chains, key=len)
+        kept = {(block['index'], dns.bc.Blockchain.hash(block)) for block in longest}
+
+        converged = len(heads) == 1
+        report = {
+            'nodes': len(self.addrs),
+            'converged': converged,
+            'distinct_heads': len(heads),
+            # None when the nodes never agreed on a chain
+            'convergence_time': max(0.0, self.last_change - self.last_write) if converged else None,
+            'messages': self.network.messages,
+            'bytes': self.network.bytes,
+            'dropped': self.network.dropped,
+            'aborted_rounds': dict(self.network.aborted),
+            'blocks_mined': len(self.mined),
+            'orphaned_blocks': len(self.mined - kept),
+            'chain_length': len(longest),
+            'lookups': self.lookups,
+            'lookup_misses': self.lookup_misses,
+        }
+        return report
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--nodes', default=50, type=int, help='number of simulated nodes')
+    parser.add_argument('-d', '--degree', default=None, type=int, help='neighbours per node, full mesh if omitted')
+    parser.add_argument('--writes', default=20, type=int, help='number of new entries')
+    parser.add_argument('--lookups', default=200, type=int, help='number of lookups')
+    parser.add_argument('--write-interval', default=0.1, type=float, help='seconds between writes')
+    parser.add_argument('--lookup-interval', default=0.01, type=float, help='seconds between lookups')
+    parser.add_argument('--latency', default=0.01, type=float, help='one way latency in seconds')
+    parser.add_argument('--jitter', default=0.0, type=float, help='maximum extra random latency in seconds')
+    parser.add_argument('--loss', default=0.0, type=float, help='probability a message is dropped')
+    parser.add_argument('--timeout', default=1.0, type=float, help='seconds a sender waits for a dropped message')
+    parser.add_argument('--seed', default=None, type=int, help='random seed')
+    args = parser.parse_args()
+
+    sim = ClusterSimulator(args.nodes, degree=args.degree, latency=args.latency,
+        jitter=args.jitter, loss=args.loss, timeout=args.timeout, seed=args.seed)
+    report = sim.run(args.writes, args.lookups, args.write_interval, args.lookup_interval)
+    print(json.dumps(report, indent=2))